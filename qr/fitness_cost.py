@@ -1,31 +1,45 @@
 import numpy as np
 from qr.adr_theory import *
+from qr.jit_kernel import _NUMBA_AVAILABLE
+
+if _NUMBA_AVAILABLE:
+    import numba
+
+# integer codes of the fitness functions used by the compiled cost kernel
+COST_DEFAULT = 0
+COST_STAR = 1
 
 
 def cost(u, indices, tree_shape, cost_func, k, q_size, shape_coef, abratio):
     """
     Given the probability distribution of unrooted quintet trees u,
-    the partial order of a tree R, and the type of the fitness function,
-    returns the cost Cost(R, u)
+    the partial orders of m trees R with the same topological shape, and the type of the fitness function,
+    returns the costs Cost(R, u) of all m trees
     :param shape_coef: coefficient for shape penalty term
     :param k: number of genes
     :param n: number of taxa in the species tree
     :param np.ndarray u: unrooted quintet tree probability distribution
-    :param list indices: partial order on tree R in the form of a list of indices
-    :param str tree_shape: topological shape of tree R
+    :param np.ndarray indices: partial orders on trees R in the form of an m x 15 array of indices
+    :param str tree_shape: topological shape of trees R
     :param str cost_func: type of the fitness function
-    :rtype: float
+    :rtype: np.ndarray
     """
-    invariant_score = 0
-    inequality_score = 0
+    if _NUMBA_AVAILABLE:
+        class_members, class_sizes, inequalities = partial_order_arrays[tree_shape]
+        shape_penalty = shape_coef * int(topological_shape(u, k, q_size) != tree_shape)
+        costs = np.zeros(len(indices))
+        cost_kernel(u, indices, class_members, class_sizes, inequalities,
+                    COST_STAR if cost_func == 'star' else COST_DEFAULT, abratio, shape_penalty, costs)
+        return costs
+    u_r = u[indices]
+    invariant_score = np.zeros(len(indices))
+    inequality_score = np.zeros(len(indices))
     equiv_classes, inequalities = get_partial_order(tree_shape)
     est_shape = topological_shape(u, k, q_size)
     # similarity inside equiv classes
     for c in equiv_classes:
-        intraclass_sim = 0
-        for i in range(len(c)):
-            for j in range(len(c)):
-                intraclass_sim += invariant_metric(u[indices[c[i]]], u[indices[c[j]]])
+        u_c = u_r[:, c]
+        intraclass_sim = np.sum(invariant_metric(u_c[:, :, None], u_c[:, None, :]), axis=(1, 2))
         if cost_func == 'star':
             invariant_score += intraclass_sim
         else:
@@ -33,10 +47,9 @@ def cost(u, indices, tree_shape, cost_func, k, q_size, shape_coef, abratio):
 
     # distance between equiv classes
     for ineq in inequalities:
-        interclass_distance = 0
-        for i in equiv_classes[ineq[0]]:
-            for j in equiv_classes[ineq[1]]:
-                interclass_distance += inequality_metric(u[indices[j]], u[indices[i]])
+        u_lower = u_r[:, equiv_classes[ineq[0]]]
+        u_upper = u_r[:, equiv_classes[ineq[1]]]
+        interclass_distance = np.sum(inequality_metric(u_upper[:, None, :], u_lower[:, :, None]), axis=(1, 2))
         if cost_func == 'star':
             inequality_score += interclass_distance
         else:
@@ -45,6 +58,66 @@ def cost(u, indices, tree_shape, cost_func, k, q_size, shape_coef, abratio):
     return invariant_score * abratio + inequality_score + shape_coef * int(est_shape != tree_shape)
 
 
+def get_partial_order_arrays(tree_shape):
+    """
+    Given a rooted model tree topological shape, return its partial order in the form of arrays,
+    with equivalence classes padded by -1
+    :param str tree_shape: topological shape of the model tree
+    :rtype: np.ndarray, np.ndarray, np.ndarray
+    """
+    equiv_classes, inequalities = get_partial_order(tree_shape)
+    class_sizes = np.array([len(c) for c in equiv_classes], dtype=np.int64)
+    class_members = np.full((len(equiv_classes), class_sizes.max()), -1, dtype=np.int64)
+    for i in range(len(equiv_classes)):
+        class_members[i, :class_sizes[i]] = equiv_classes[i]
+    return class_members, class_sizes, np.array(inequalities, dtype=np.int64)
+
+
+partial_order_arrays = {tree_shape: get_partial_order_arrays(tree_shape) for tree_shape in ('c', 'p', 'b')}
+
+
+if _NUMBA_AVAILABLE:
+    @numba.njit(cache=True)
+    def cost_kernel(u, indices, class_members, class_sizes, inequalities, cost_code, abratio, shape_penalty, out):
+        """
+        Compiled version of cost for m trees R with the same topological shape
+        :param np.ndarray u: unrooted quintet tree probability distribution
+        :param np.ndarray indices: partial orders on trees R in the form of an m x 15 array of indices
+        :param np.ndarray class_members, class_sizes, inequalities: partial order of the shape of trees R
+        :param int cost_code: COST_STAR or COST_DEFAULT
+        :param np.ndarray out: output array of length m
+        """
+        for r in range(indices.shape[0]):
+            invariant_score = 0.0
+            for c in range(class_members.shape[0]):
+                intraclass_sim = 0.0
+                for i in range(class_sizes[c]):
+                    for j in range(class_sizes[c]):
+                        intraclass_sim += abs(u[indices[r, class_members[c, i]]] - u[indices[r, class_members[c, j]]])
+                if cost_code == COST_STAR:
+                    invariant_score += intraclass_sim
+                else:
+                    invariant_score += intraclass_sim / class_sizes[c]
+            inequality_score = 0.0
+            for ineq in range(inequalities.shape[0]):
+                lower, upper = inequalities[ineq, 0], inequalities[ineq, 1]
+                interclass_distance = 0.0
+                for i in range(class_sizes[lower]):
+                    for j in range(class_sizes[upper]):
+                        d = u[indices[r, class_members[upper, j]]] - u[indices[r, class_members[lower, i]]]
+                        if d > 0:
+                            interclass_distance += d
+                if cost_code == COST_STAR:
+                    inequality_score += interclass_distance
+                else:
+                    inequality_score += interclass_distance / class_sizes[lower]
+            out[r] = invariant_score * abratio + inequality_score + shape_penalty
+
+    # compiling (or loading from cache) the kernel once at import
+    cost_kernel(np.zeros(15), np.zeros((1, 15), dtype=np.int64), *partial_order_arrays['c'], COST_DEFAULT, 1.0, 0.0,
+                np.zeros(1))
+
+
 def topological_shape(u, k, q_size):
     u_sorted = np.sort(u)
     threshold = A(k, q_size) # this could correspond to a lower bound on f(r) of the species tree
@@ -0,0 +1,38 @@
+import numpy as np
+
+try:
+    import numba
+    _NUMBA_AVAILABLE = True
+except ImportError:
+    _NUMBA_AVAILABLE = False
+
+
+if _NUMBA_AVAILABLE:
+    @numba.njit(parallel=True, cache=True)
+    def accumulate(labels, scores, out):
+        """
+        Sums the costs of the induced rooted quintets for every rooted candidate tree
+        :param np.ndarray labels: |R| x |Q*| table of indices (0-6) of induced rooted quintets
+        :param np.ndarray scores: |Q*| x 7 table of costs of the rootings of each sampled quintet
+        :param np.ndarray out: output array of length |R|, accumulated in float64
+        """
+        for i in numba.prange(labels.shape[0]):
+            s = 0.0
+            for j in range(labels.shape[1]):
+                s += scores[j, labels[i, j]]
+            out[i] = s
+
+
+def score_rooted_trees(labels, quintet_scores):
+    """
+    Computes the score of each rooted candidate tree from the table of its induced rooted quintets
+    :param np.ndarray labels: |R| x |Q*| table of indices (0-6) of induced rooted quintets
+    :param np.ndarray quintet_scores: |Q*| x 7 table of costs of the rootings of each sampled quintet
+    :rtype: np.ndarray
+    """
+    if _NUMBA_AVAILABLE:
+        r_score = np.zeros(labels.shape[0])
+        accumulate(labels, quintet_scores, r_score)
+        return r_score
+    # without numba, the costs are gathered for all (i, j) pairs at once and summed over quintets
+    return quintet_scores[np.arange(labels.shape[1])[None, :], labels].sum(axis=1, dtype=np.float64)
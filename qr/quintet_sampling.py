@@ -1,6 +1,7 @@
 import random
 import dendropy
 import itertools
+import numpy as np
 
 
 def linear_quintet_encoding_sample(unrooted_tree, taxon_set, multiplicity=1):
@@ -83,3 +84,29 @@ def triplet_cover_sample(taxon_set):
         trip_prime = random.sample([x for x in taxon_set if x not in trip], 2)
         sample_quintet_taxa.append(tuple(list(trip) + list(trip_prime)))
     return sample_quintet_taxa
+
+
+def exhaustive_sample(n):
+    """
+    Returns all C(n, 5) quintets of n taxa as rows of taxon indices
+    :param int n: number of taxa
+    :rtype: np.ndarray
+    """
+    q_size = n * (n - 1) * (n - 2) * (n - 3) * (n - 4) // 120
+    sample_quintets = np.fromiter(itertools.chain.from_iterable(itertools.combinations(range(n), 5)),
+                                  dtype=np.int32, count=5 * q_size)
+    return sample_quintets.reshape(q_size, 5)
+
+
+def taxa_to_indices(sample_quintet_taxa, taxon_set):
+    """
+    Converts a list of quintets of taxa labels to rows of indices of the taxa in taxon_set
+    :param list sample_quintet_taxa: list of labels of 5 taxa
+    :param list taxon_set: labels of taxa
+    :rtype: np.ndarray
+    """
+    taxon_indices = {label: i for i, label in enumerate(taxon_set)}
+    sample_quintets = np.zeros((len(sample_quintet_taxa), 5), dtype=np.int32)
+    for j in range(len(sample_quintet_taxa)):
+        sample_quintets[j] = [taxon_indices[label] for label in sample_quintet_taxa[j]]
+    return sample_quintets
@@ -1,6 +1,5 @@
 import numpy as np
 import dendropy
-import re
 
 
 def plot_unrooted_gene_dist(u_distribution, ax, title):
@@ -36,63 +35,6 @@ def taxon_set_map(t1, t2, tns):
     return taxon_map
 
 
-# the code of this function is taken from https://gist.github.com/bgusach/a967e0587d6e01e889fd1d776c5f3729
-# thanks to @bgusach
-def multireplace(string, replacements, ignore_case=False):
-    """
-    Given a string and a replacement map, it returns the replaced string.
-    :param str string: string to execute replacements on
-    :param dict replacements: replacement dictionary {value to find: value to replace}
-    :param bool ignore_case: whether the match should be case insensitive
-    :rtype: str
-    """
-    if not replacements:
-        # Edge case that'd produce a funny regex and cause a KeyError
-        return string
-
-    # If case insensitive, we need to normalize the old string so that later a replacement
-    # can be found. For instance with {"HEY": "lol"} we should match and find a replacement for "hey",
-    # "HEY", "hEy", etc.
-    if ignore_case:
-        def normalize_old(s):
-            return s.lower()
-
-        re_mode = re.IGNORECASE
-    else:
-        def normalize_old(s):
-            return s
-
-        re_mode = 0
-
-    replacements = {normalize_old(key): val for key, val in replacements.items()}
-
-    # Place longer ones first to keep shorter substrings from matching where the longer ones should take place
-    # For instance given the replacements {'ab': 'AB', 'abc': 'ABC'} against the string 'hey abc', it should produce
-    # 'hey ABC' and not 'hey ABc'
-    rep_sorted = sorted(replacements, key=len, reverse=True)
-    rep_escaped = map(re.escape, rep_sorted)
-
-    # Create a big OR regex that matches any of the substrings to replace
-    pattern = re.compile("|".join(rep_escaped), re_mode)
-
-    # For each match, look up the new string in the replacements, being the key the normalized old string
-    return pattern.sub(lambda match: replacements[normalize_old(match.group(0))], string)
-
-
-def map_taxon_namespace(string, taxa_labels):
-    """
-    Given a quintet tree with taxa labels 1-5 as a string and a set of taxa,
-    returns a mapped version of strings with taxa in set taxa_labels
-    :param str string: string of a quintet tree with taxa 1-5
-    :param tuple taxa_labels: taxa labels to be mapped to
-    :rtype: str
-    """
-    taxa_map_dict = dict()
-    for i in range(len(taxa_labels)):
-        taxa_map_dict[str(i + 1)] = taxa_labels[i]
-    return multireplace(string, taxa_map_dict)
-
-
 def idx_2_unlabeled_topology(idx):
     """
     Given an index of a rooted binary tree (1-105), returns its topological shape
@@ -108,37 +50,107 @@ def idx_2_unlabeled_topology(idx):
     return None
 
 
-def get_quintet_unrooted_index(subtree_u, quintets_u):
+def quintet_signature(tree, taxon_positions, rooted):
+    """
+    Returns the signature of a 5-taxon tree, i.e. the set of its nontrivial clades (or nontrivial
+    bipartitions if unrooted) given as bitmasks over the positions of its taxa in the quintet. The set is
+    packed in a single integer with one bit for each of the 32 possible bitmasks
+    :param dendropy.Tree tree: a 5-taxon tree
+    :param dict taxon_positions: mapping from taxa labels to their positions (0-4) in the quintet
+    :param bool rooted: whether tree is rooted
+    :rtype: int
+    """
+    node_masks = dict()
+    signature = 0
+    for node in tree.postorder_node_iter():
+        if node.is_leaf():
+            node_masks[node] = 1 << taxon_positions[node.taxon.label]
+            continue
+        mask = 0
+        for child in node.child_node_iter():
+            mask |= node_masks[child]
+        node_masks[node] = mask
+        clade_size = bin(mask).count('1')
+        if rooted and 1 < clade_size < 5:
+            signature |= 1 << mask
+        elif not rooted and 1 < clade_size < 4:
+            # bipartitions of unrooted trees are represented by the side without the first taxon
+            signature |= 1 << (mask ^ 0b11111 if mask & 1 else mask)
+    return signature
+
+
+def base_quintet_signatures(quintets_base, rooted):
+    """
+    Returns the signatures of quintet trees with taxa labels 1-5
+    :param dendropy.TreeList quintets_base: quintet trees with taxa 1-5
+    :param bool rooted: whether quintet trees are rooted
+    :rtype: np.ndarray
+    """
+    taxon_positions = {str(i + 1): i for i in range(5)}
+    return np.array([quintet_signature(q, taxon_positions, rooted) for q in quintets_base], dtype=np.int64)
+
+
+def lookup_quintet_unrooted_index(subtree_u, taxon_positions, unrooted_table):
     """
     Returns the index of an unrooted quintet tree on a set of taxa
     :param dendropy.Tree subtree_u: an unrooted 5-taxon tree
-    :param list quintets_u: list of 15 unrooted quintet trees
+    :param dict taxon_positions: mapping from taxa labels to their positions (0-4) in the quintet
+    :param dict unrooted_table: mapping from signatures of the 15 unrooted quintet trees to their indices
     :rtype: int
     """
-    idx_u = -1
-    for i in range(len(quintets_u)):
-        if dendropy.calculate.treecompare.symmetric_difference(quintets_u[i], subtree_u) == 0:
-            idx_u = i
-            break
-    return idx_u
+    return unrooted_table.get(quintet_signature(subtree_u, taxon_positions, False), -1)
 
 
-def get_quintet_rooted_index(subtree_r, quintets_r, u_idx):
+def get_rooting_indices(signatures_r, rooting_signatures):
     """
-    Returns the index of a rooted quintet tree
-    :param dendropy.Tree subtree_r: an unrooted 5-taxon tree on q_taxa
-    :param list quintets_r: list of 105 rooted quintet trees on q_taxa
-    :param int u_idx: index of unrooted quintet tree u
-    :rtype: int
+    Returns the indices of rooted quintet trees among the 7 rootings of an unrooted quintet tree u,
+    and -1 for trees that are not a rooting of u
+    :param np.ndarray signatures_r: signatures of rooted 5-taxon trees, with one column for each quintet
+    :param np.ndarray rooting_signatures: signatures of the 7 rootings of u for each quintet
+    :rtype: np.ndarray
+    """
+    matches = signatures_r[..., None] == rooting_signatures
+    return np.where(matches.any(axis=-1), matches.argmax(axis=-1), -1)
+
+
+def candidate_clade_table(candidate_clades, n):
+    """
+    Given the clades of a set of rooted trees on n taxa, returns the membership matrix of their distinct
+    nontrivial clades and, for each tree, the indices of its clades in this matrix. The last row of the
+    matrix is an empty clade used for padding trees with fewer clades
+    :param list candidate_clades: frozensets of clade bitmasks of rooted trees
+    :param int n: number of taxa
+    :rtype: np.ndarray, np.ndarray
+    """
+    clade_ids = dict()
+    tree_clades = []
+    for clades in candidate_clades:
+        tree_clades.append([clade_ids.setdefault(c, len(clade_ids)) for c in clades if 1 < bin(c).count('1') < n])
+    clade_members = np.zeros((len(clade_ids) + 1, n), dtype=np.uint8)
+    for c, idx in clade_ids.items():
+        clade_bytes = np.frombuffer(c.to_bytes((n + 7) // 8, 'little'), dtype=np.uint8)
+        clade_members[idx] = np.unpackbits(clade_bytes, bitorder='little')[:n]
+    clade_indices = np.full((len(tree_clades), max(len(ids) for ids in tree_clades)), len(clade_ids), dtype=np.int32)
+    for i in range(len(tree_clades)):
+        clade_indices[i, :len(tree_clades[i])] = tree_clades[i]
+    return clade_members, clade_indices
+
+
+# bit of each 5-taxon clade bitmask in a rooted quintet signature, or 0 if the clade is trivial
+rooted_clade_bits = np.array([1 << m if 1 < bin(m).count('1') < 5 else 0 for m in range(32)], dtype=np.int64)
+
+
+def induced_rooted_signatures(clade_members, clade_indices, sample_quintets):
     """
-    from qr.adr_theory import u2r_mapping
-    idx_r = -1
-    for i in range(7):
-        idx = u2r_mapping[u_idx][i]
-        if dendropy.calculate.treecompare.symmetric_difference(quintets_r[idx], subtree_r) == 0:
-            idx_r = i
-            break
-    return idx_r
+    Returns the signatures of the rooted quintet trees induced by a set of rooted trees on sampled quintets,
+    computed from the intersections of the clades of each tree with each quintet
+    :param np.ndarray clade_members: membership matrix of clades returned by candidate_clade_table
+    :param np.ndarray clade_indices: indices of the clades of each rooted tree in clade_members
+    :param np.ndarray sample_quintets: sampled quintets as rows of indices of 5 taxa
+    :rtype: np.ndarray
+    """
+    quintet_masks = clade_members[:, sample_quintets] @ (1 << np.arange(5, dtype=np.uint8))
+    return np.bitwise_or.reduce(rooted_clade_bits[quintet_masks[clade_indices]], axis=1)
 
 
 def gene_tree_distribution(gene_trees, q_taxa, quintets_u, normalized):
@@ -167,3 +179,28 @@ def gene_tree_distribution(gene_trees, q_taxa, quintets_u, normalized):
     else:
         u_distribution = u_count / len(gene_trees)
     return u_distribution
+
+
+def quintet_tree_distributions(gene_trees, sample_quintets, taxon_set, normalized):
+    """
+    Given a set of gene trees and a list of sampled quintets of taxa, estimates the quintet
+    distribution on the induced gene subtrees of each quintet, with one tally over the gene trees
+    per distinct quintet and a single vectorized normalization of all distributions
+    :param table_five.TreeSet gene_trees: a set of unrooted gene trees
+    :param np.ndarray sample_quintets: sampled quintets as rows of indices of 5 taxa in taxon_set
+    :param list taxon_set: labels of taxa
+    :param bool normalized: normalization by the number of gene trees having a quintet rather than all gene trees
+    :rtype: np.ndarray
+    """
+    # quintets sampled more than once are only tallied once, at their first occurrence
+    _, first_indices, inverse_indices = np.unique(sample_quintets, axis=0, return_index=True, return_inverse=True)
+    quintet_counts = np.zeros((len(sample_quintets), 15))
+    for j in first_indices:
+        quintet_counts[j] = gene_trees.tally_single_quintet(tuple(taxon_set[x] for x in sample_quintets[j]))
+    if len(first_indices) < len(sample_quintets):
+        quintet_counts = quintet_counts[first_indices[inverse_indices.reshape(-1)]]
+    if normalized:
+        quintet_normalizers = np.sum(quintet_counts, axis=1, keepdims=True)
+    else:
+        quintet_normalizers = np.full((len(sample_quintets), 1), len(gene_trees))
+    return np.divide(quintet_counts, quintet_normalizers, out=quintet_counts, where=quintet_normalizers != 0)
@@ -1,4 +1,5 @@
 import argparse
+import multiprocessing
 import time
 import dendropy
 import numpy as np
@@ -7,6 +8,7 @@ from table_five import TreeSet
 
 from qr.adr_theory import *
 from qr.fitness_cost import *
+from qr.jit_kernel import score_rooted_trees
 from qr.quintet_sampling import *
 from qr.utils import *
 from qr.version import __version__
@@ -26,6 +28,8 @@ def main(args):
     shape_coef = args.coef
     mult_le = args.multiplicity
     abratio = args.abratio
+    if args.topk is not None and args.topk < 1:
+        raise Exception("Number of top-ranked rooted trees should be at least 1!\n")
 
     header = """*********************************
 *     Quintet Rooting """ + __version__ + """    *
@@ -42,8 +46,6 @@ def main(args):
 
     # reading fixed quintet topology files
     tns_base = dendropy.TaxonNamespace()
-    unrooted_quintets_base = dendropy.TreeList.get(path=script_path + '/qr/topologies/quintets.tre',
-                                                   taxon_namespace=tns_base, schema='newick')
     rooted_quintets_base = dendropy.TreeList(taxon_namespace=tns_base)
     rooted_quintets_base.read(path=script_path + '/qr/topologies/caterpillar.tre', schema='newick',
                               rooting="default-rooted")
@@ -51,29 +53,29 @@ def main(args):
                               rooting="default-rooted")
     rooted_quintets_base.read(path=script_path + '/qr/topologies/balanced.tre', schema='newick',
                               rooting="default-rooted")
-    rooted_quintet_indices = np.load(script_path + '/qr/rooted_quintet_indices.npy')
+    rooted_quintet_signatures = base_quintet_signatures(rooted_quintets_base, rooted=True)
 
     sys.stdout.write('Loading time: %.2f sec\n' % (time.time() - st_time))
     ss_time = time.time()
 
     # search space of rooted trees
-    rooted_candidates = get_all_rooted_trees(unrooted_species)
-    r_score = np.zeros(len(rooted_candidates))
+    rooted_candidates, candidate_clades = get_all_rooted_trees(unrooted_species)
 
     sys.stdout.write('Creating search space time: %.2f sec\n' % (time.time() - ss_time))
     sm_time = time.time()
 
-    # set of sampled quintets
+    # set of sampled quintets, as rows of indices of taxa in taxon_set
     taxon_set = [t.label for t in tns]
-    sample_quintet_taxa = []
+    sample_quintets = np.zeros((0, 5), dtype=np.int32)
     if len(taxon_set) == 5 or sampling_method == 'exh':
-        sample_quintet_taxa = list(itertools.combinations(taxon_set, 5))
+        sample_quintets = exhaustive_sample(len(taxon_set))
     elif sampling_method == 'tc':
-        sample_quintet_taxa = triplet_cover_sample(taxon_set)
+        sample_quintets = taxa_to_indices(triplet_cover_sample(taxon_set), taxon_set)
     elif sampling_method == 'le':
-        sample_quintet_taxa = linear_quintet_encoding_sample(unrooted_species, taxon_set, mult_le)
+        sample_quintets = taxa_to_indices(linear_quintet_encoding_sample(unrooted_species, taxon_set, mult_le),
+                                          taxon_set)
     elif sampling_method == 'rl':
-        sample_quintet_taxa = random_linear_sample(taxon_set)
+        sample_quintets = taxa_to_indices(random_linear_sample(taxon_set), taxon_set)
 
     sys.stdout.write('Quintet sampling time: %.2f sec\n' % (time.time() - sm_time))
     proc_time = time.time()
@@ -81,70 +83,112 @@ def main(args):
     sys.stdout.write("Number of taxa (n): %d\n" % len(tns))
     sys.stdout.write("Number of gene trees (k): %d\n" % len(gene_trees))
     sys.stdout.write("Size of search space (|R|): %d\n" % len(rooted_candidates))
-    sys.stdout.write("Size of sampled quintets set (|Q*|): %d\n" % len(sample_quintet_taxa))
+    sys.stdout.write("Size of sampled quintets set (|Q*|): %d\n" % len(sample_quintets))
 
     # preprocessing
-    quintet_scores = np.zeros((len(sample_quintet_taxa), 7))
-    quintet_unrooted_indices = np.zeros(len(sample_quintet_taxa), dtype=int)
-    quintets_r_all = []
-
-    for j in range(len(sample_quintet_taxa)):
-        q_taxa = sample_quintet_taxa[j]
-        quintets_u = [
-            dendropy.Tree.get(data=map_taxon_namespace(str(q), q_taxa) + ';', schema='newick', rooting='force-unrooted',
-                              taxon_namespace=tns) for q in unrooted_quintets_base]
-        quintets_r = [
-            dendropy.Tree.get(data=map_taxon_namespace(str(q), q_taxa) + ';', schema='newick', rooting='force-rooted',
-                              taxon_namespace=tns) for q in rooted_quintets_base]
-        subtree_u = unrooted_species.extract_tree_with_taxa_labels(labels=q_taxa, suppress_unifurcations=True)
-        quintet_counts = np.asarray(gene_trees.tally_single_quintet(q_taxa))
-        quintet_normalizer = sum(quintet_counts) if args.normalized else len(gene_trees)
-        quintet_tree_dist = quintet_counts
-        if quintet_normalizer != 0:
-            quintet_tree_dist = quintet_tree_dist / quintet_normalizer
-        quintet_unrooted_indices[j] = get_quintet_unrooted_index(subtree_u, quintets_u)
-        quintet_scores[j] = compute_cost_rooted_quintets(quintet_tree_dist, quintet_unrooted_indices[j],
-                                                         rooted_quintet_indices, cost_func, len(gene_trees),
-                                                         len(sample_quintet_taxa), shape_coef, abratio)
-        quintets_r_all.append(quintets_r)
+    quintet_scores = np.zeros((len(sample_quintets), 7), dtype=np.float32)
+    quintet_unrooted_indices = np.zeros(len(sample_quintets), dtype=int)
+    quintet_tree_dists = quintet_tree_distributions(gene_trees, sample_quintets, taxon_set, args.normalized)
+
+    preprocess_args = (species_tree_path, script_path, cost_func, len(gene_trees), len(sample_quintets),
+                       shape_coef, abratio)
+    preprocess_tasks = ((j, tuple(taxon_set[x] for x in sample_quintets[j]), quintet_tree_dists[j])
+                        for j in range(len(sample_quintets)))
+    pool = None
+    if args.threads > 1:
+        pool = multiprocessing.Pool(args.threads, initializer=init_preprocess, initargs=preprocess_args)
+        chunk_size = max(1, len(sample_quintets) // (8 * args.threads))
+        preprocess_results = pool.imap_unordered(preprocess_quintet, preprocess_tasks, chunksize=chunk_size)
+    else:
+        init_preprocess(*preprocess_args)
+        preprocess_results = map(preprocess_quintet, preprocess_tasks)
+    for j, u_idx, costs in preprocess_results:
+        quintet_unrooted_indices[j] = u_idx
+        quintet_scores[j] = costs
+    if pool is not None:
+        pool.close()
+        pool.join()
 
     sys.stdout.write('Preprocessing time: %.2f sec\n' % (time.time() - proc_time))
     sc_time = time.time()
 
     # computing scores
-    min_score = sys.maxsize
-    for i in range(len(rooted_candidates)):
-        r = rooted_candidates[i]
-        for j in range(len(sample_quintet_taxa)):
-            q_taxa = sample_quintet_taxa[j]
-            subtree_r = r.extract_tree_with_taxa_labels(labels=q_taxa, suppress_unifurcations=True)
-            r_idx = get_quintet_rooted_index(subtree_r, quintets_r_all[j], quintet_unrooted_indices[j])
-            r_score[i] += quintet_scores[j][r_idx]
-            if not args.confidencescore and r_score[i] > min_score:
-                break
-        if r_score[i] < min_score:
-            min_score = r_score[i]
+    # signatures of the 7 rootings of the unrooted species quintet of each sampled quintet
+    quintet_rooting_signatures = rooted_quintet_signatures[u2r_mapping[quintet_unrooted_indices]]
+    quintet_rooted_labels = np.zeros((len(rooted_candidates), len(sample_quintets)), dtype=np.int8)
+    clade_members, clade_indices = candidate_clade_table(candidate_clades, len(taxon_set))
+    # quintets are processed in batches to bound the size of the |R| x clades x batch intermediate array
+    batch_size = max(1, 2 ** 22 // clade_indices.size)
+    for start in range(0, len(sample_quintets), batch_size):
+        batch = slice(start, start + batch_size)
+        signatures_r = induced_rooted_signatures(clade_members, clade_indices, sample_quintets[batch])
+        quintet_rooted_labels[:, batch] = get_rooting_indices(signatures_r, quintet_rooting_signatures[batch])
+    r_score = score_rooted_trees(quintet_rooted_labels, quintet_scores)
 
     min_idx = np.argmin(r_score)
+    best_rooted_tree = rooted_candidates[min_idx]
     with open(output_path, 'w') as fp:
-        fp.write(str(rooted_candidates[min_idx]) + ';\n')
+        fp.write(best_rooted_tree + ';\n')
 
     sys.stdout.write('Scoring time: %.2f sec\n' % (time.time() - sc_time))
-    sys.stdout.write('Best rooting: \n%s \n' % str(rooted_candidates[min_idx]))
+    sys.stdout.write('Best rooting: \n%s \n' % best_rooted_tree)
 
     # computing confidence scores
     if args.confidencescore:
         sys.stdout.write('Scores of all rooted trees:\n %s \n' % str(r_score))
-        confidence_scores = (np.max(r_score) - r_score) / np.sum(np.max(r_score) - r_score)
-        tree_ranking_indices = np.argsort(r_score)
+        score_gaps = r_score.max() - r_score
+        confidence_scores = score_gaps / score_gaps.sum()
+        if args.topk is not None and args.topk < len(r_score):
+            # only the k best rooted trees are ranked, so the rest do not need to be sorted
+            tree_ranking_indices = np.argpartition(r_score, args.topk - 1)[:args.topk]
+            tree_ranking_indices = tree_ranking_indices[np.argsort(r_score[tree_ranking_indices])]
+        else:
+            tree_ranking_indices = np.argsort(r_score)
         with open(output_path + ".rank.cfn", 'w') as fp:
             for i in tree_ranking_indices:
-                fp.write(str(rooted_candidates[i]) + ';\n')
+                fp.write(rooted_candidates[i] + ';\n')
                 fp.write(str(confidence_scores[i]) + '\n')
 
     sys.stdout.write('Total execution time: %.2f sec\n' % (time.time() - st_time))
 
 
+# state of a preprocessing process, set once by init_preprocess
+preprocess_state = dict()
+
+
+def init_preprocess(species_tree_path, script_path, cost_func, k, q_size, shape_coef, abratio):
+    """
+    Loads the unrooted species tree and the signatures of unrooted quintet topologies used for preprocessing
+    sampled quintets
+    :param str species_tree_path: path of the unrooted species tree
+    :param str script_path: path of the base directory of QR
+    :param str cost_func: type of the fitness function
+    """
+    preprocess_state['unrooted_species'] = dendropy.Tree.get(path=species_tree_path, schema='newick',
+                                                             rooting="force-unrooted", suppress_edge_lengths=True)
+    unrooted_quintets_base = dendropy.TreeList.get(path=script_path + '/qr/topologies/quintets.tre', schema='newick')
+    unrooted_quintet_signatures = base_quintet_signatures(unrooted_quintets_base, rooted=False)
+    preprocess_state['unrooted_quintet_table'] = {sig: i for i, sig in enumerate(unrooted_quintet_signatures.tolist())}
+    preprocess_state['rooted_quintet_indices'] = np.load(script_path + '/qr/rooted_quintet_indices.npy')
+    preprocess_state['cost_args'] = (cost_func, k, q_size, shape_coef, abratio)
+
+
+def preprocess_quintet(task):
+    """
+    Finds the unrooted species quintet on a sampled quintet of taxa and scores its 7 possible rootings
+    :param tuple task: index of the quintet, labels of its 5 taxa, and its unrooted quintet tree distribution
+    :rtype: tuple
+    """
+    j, q_taxa, u_distribution = task
+    taxon_positions = {q_taxa[x]: x for x in range(5)}
+    subtree_u = preprocess_state['unrooted_species'].extract_tree_with_taxa_labels(labels=q_taxa,
+                                                                                   suppress_unifurcations=True)
+    u_idx = lookup_quintet_unrooted_index(subtree_u, taxon_positions, preprocess_state['unrooted_quintet_table'])
+    costs = compute_cost_rooted_quintets(u_distribution, u_idx, preprocess_state['rooted_quintet_indices'],
+                                         *preprocess_state['cost_args'])
+    return j, u_idx, costs
+
+
 def compute_cost_rooted_quintets(u_distribution, u_idx, rooted_quintet_indices, cost_func, k, q_size, shape_coef, abratio):
     """
     Scores the 7 possible rootings of an unrooted quintet
@@ -155,36 +199,68 @@ def compute_cost_rooted_quintets(u_distribution, u_idx, rooted_quintet_indices,
     :rtype: np.ndarray
     """
     rooted_tree_indices = u2r_mapping[u_idx]
-    costs = np.zeros(7)
-    for i in range(7):
-        idx = rooted_tree_indices[i]
-        unlabeled_topology = idx_2_unlabeled_topology(idx)
-        indices = rooted_quintet_indices[idx]
-        costs[i] = cost(u_distribution, indices, unlabeled_topology, cost_func, k, q_size, shape_coef, abratio)
+    unlabeled_topologies = np.array([idx_2_unlabeled_topology(idx) for idx in rooted_tree_indices])
+    costs = np.zeros(7, dtype=np.float32)
+    # rootings with the same unlabeled topology share a partial order, so each shape is scored at once
+    for unlabeled_topology in np.unique(unlabeled_topologies):
+        group = unlabeled_topologies == unlabeled_topology
+        indices = rooted_quintet_indices[rooted_tree_indices[group]]
+        costs[group] = cost(u_distribution, indices, unlabeled_topology, cost_func, k, q_size, shape_coef, abratio)
     return costs
 
 
 def get_all_rooted_trees(unrooted_tree):
     """
-    Generates all the possible rooted trees with a given unrooted topology
+    Generates all the possible rooted trees with a given unrooted topology, as newick strings
+    together with their sets of clades
     :param dendropy.Tree unrooted_tree: an unrooted tree topology
-    :rtype: list
+    :rtype: tuple[list, list]
     """
     rooted_candidates = []
+    candidate_clades = []
+    seen = set()
     tree = dendropy.Tree(unrooted_tree)
-    for edge in tree.preorder_edge_iter():
-        try:
-            tree.reroot_at_edge(edge, update_bipartitions=True)
-            rooted_candidates.append(dendropy.Tree(tree))
-        except:
-            continue
-    # removing duplicates
-    rooted_candidates[0].resolve_polytomies(update_bipartitions=True)
-    for i in range(1, len(rooted_candidates)):
-        if dendropy.calculate.treecompare.symmetric_difference(rooted_candidates[0], rooted_candidates[i]) == 0:
-            rooted_candidates.pop(0)
-            break
-    return rooted_candidates
+    taxon_bitmasks = {taxon: tree.taxon_namespace.taxon_bitmask(taxon) for taxon in tree.taxon_namespace}
+    node_bitmasks = clade_bitmasks(tree, taxon_bitmasks)
+    all_taxa_bitmask = node_bitmasks[tree.seed_node]
+    # rerooting changes the edges of the tree, so edges are listed upfront by their bitmasks
+    # and looked up again in the rerooted tree, where an edge may have the complementary bitmask
+    edge_bitmasks = [node_bitmasks[node] for node in tree.preorder_node_iter() if node.parent_node is not None]
+    for bitmask in edge_bitmasks:
+        bitmask_nodes = {node_bitmask: node for node, node_bitmask in node_bitmasks.items()}
+        node = bitmask_nodes.get(bitmask, bitmask_nodes.get(bitmask ^ all_taxa_bitmask))
+        if node is None:
+            raise Exception('Edge with bitmask %s not found after rerooting the species tree' % bin(bitmask))
+        # dendropy's bipartitions are not needed, as the clades are recomputed below
+        tree.reroot_at_edge(node.edge, update_bipartitions=False)
+        node_bitmasks = clade_bitmasks(tree, taxon_bitmasks)
+        # only the newick string and the clades of each rooting are kept, and rerooting at different
+        # edges can give the same rooted tree, so duplicates are removed by their set of clades
+        clades = frozenset(node_bitmasks.values())
+        if clades not in seen:
+            seen.add(clades)
+            rooted_candidates.append(str(tree))
+            candidate_clades.append(clades)
+    return rooted_candidates, candidate_clades
+
+
+def clade_bitmasks(tree, taxon_bitmasks):
+    """
+    Computes the bitmask of the leaves below each node of a tree in a single postorder traversal
+    :param dendropy.Tree tree: a tree
+    :param dict taxon_bitmasks: bitmask of each taxon of the tree
+    :rtype: dict
+    """
+    node_bitmasks = {}
+    for node in tree.postorder_node_iter():
+        if node.is_leaf():
+            node_bitmasks[node] = taxon_bitmasks[node.taxon]
+        else:
+            bitmask = 0
+            for child in node.child_node_iter():
+                bitmask |= node_bitmasks[child]
+            node_bitmasks[node] = bitmask
+    return node_bitmasks
 
 
 def parse_args():
@@ -213,6 +289,10 @@ def parse_args():
     parser.add_argument("-cfs", "--confidencescore", action='store_true',
                         help="output confidence scores for each possible rooted tree as well as a ranking")
 
+    parser.add_argument("-topk", "--topk", type=int,
+                        help="number of best rooted trees written to the ranking (all by default)",
+                        required=False, default=None)
+
     parser.add_argument("-mult", "--multiplicity", type=int,
                         help="multiplicity (number of quintets mapped to each edge) in QR-LE",
                         required=False, default=1)
@@ -227,6 +307,9 @@ def parse_args():
     parser.add_argument("-abratio", "--abratio", type=float,
                         help="Ratio between invariant and inequality penalties used in QR-STAR", required=False, default=1)
 
+    parser.add_argument("-th", "--threads", type=int,
+                        help="number of processes used for preprocessing quintets", required=False, default=1)
+
     parser.add_argument("-rs", "--seed", type=int,
                         help="random seed", required=False, default=1234)
 